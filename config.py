@@ -1,7 +1,12 @@
 import os
-from typing import Dict, Any
-from dotenv import load_dotenv
-import json
+import base64
+import bisect
+import functools
+import random
+import re
+from dataclasses import dataclass
+from typing import Dict, Any, Final, Iterable, List, Optional, Tuple
+from pathlib import Path
 import tempfile
 import logging
 
@@ -10,122 +15,273 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # 環境変数の読み込み
-load_dotenv()
+# Render等のプラットフォームでは環境変数が注入済みのため、.envの読み込みを省略する
+if os.environ.get('RENDER') is None and os.environ.get('GAE_ENV') is None:
+    try:
+        if Path('.env').is_file():
+            from dotenv import load_dotenv
+            load_dotenv()
+    except ImportError:
+        pass
 
-# credentials.jsonのJSON文字列からファイル生成処理
-GOOGLE_CREDENTIALS_JSON = os.getenv('GOOGLE_CREDENTIALS_JSON')
-CREDENTIALS_FILE_PATH = os.getenv('GOOGLE_SHEETS_CREDENTIALS_FILE', 'credentials.json')
+# 環境変数のスナップショット（.envの読み込み後に作成し、以降の参照はos.environを経由せずこの辞書から行う）
+_ENV: Final = dict(os.environ)
+_E = _ENV.get
 
-def create_credentials_file():
-    """JSON文字列からcredentials.jsonファイルを作成"""
-    if GOOGLE_CREDENTIALS_JSON:
+# credentials.jsonのJSON文字列（またはBase64文字列）からファイル生成処理
+GOOGLE_CREDENTIALS_JSON = _E('GOOGLE_CREDENTIALS_JSON')
+GOOGLE_CREDENTIALS_BASE64 = _E('GOOGLE_CREDENTIALS_BASE64')
+CREDENTIALS_FILE_PATH = _E('GOOGLE_SHEETS_CREDENTIALS_FILE', 'credentials.json')
+
+# サービスアカウント認証情報の判定用パターン
+_SERVICE_ACCOUNT_RE = re.compile(rb'"type"\s*:\s*"service_account"')
+
+def _compile_tag_pattern(tags: Iterable[str]) -> re.Pattern:
+    """タグ検出用の正規表現を作成（長いタグを優先してマッチさせる）"""
+    return re.compile('|'.join(re.escape(tag) for tag in sorted(tags, key=len, reverse=True)))
+
+@functools.lru_cache(maxsize=1)
+def _materialize_credentials() -> Optional[str]:
+    """
+    環境変数の認証情報からcredentials.jsonファイルを作成
+    
+    GOOGLE_CREDENTIALS_JSONを優先し、未設定の場合はGOOGLE_CREDENTIALS_BASE64を使用します。
+    ファイルは最初の呼び出しで一度だけ作成され、以降は同じパスを返します。
+    
+    Returns:
+        作成したファイルのパス（失敗時はNone）
+    """
+    if not GOOGLE_CREDENTIALS_JSON and not GOOGLE_CREDENTIALS_BASE64:
+        logger.warning("GOOGLE_CREDENTIALS_JSON（またはGOOGLE_CREDENTIALS_BASE64）が設定されていません")
+        return None
+    
+    try:
+        # 認証情報のバイト列を取得
+        if GOOGLE_CREDENTIALS_JSON:
+            raw_credentials = GOOGLE_CREDENTIALS_JSON.encode('utf-8')
+        else:
+            raw_credentials = base64.b64decode(GOOGLE_CREDENTIALS_BASE64)
+        
+        # 認証情報の妥当性を確認（JSON全体はパースせず、typeフィールドのみ確認する）
+        if not _SERVICE_ACCOUNT_RE.search(raw_credentials):
+            raise ValueError("無効なサービスアカウント認証情報です")
+        
+        # 一時ファイルとして作成（Render環境での権限問題を回避）
+        # 元のJSONをそのまま書き出す（パースは認証ライブラリが行う）
+        # mkstempのファイルは作成ユーザーのみ読み書き可能（0600）
+        fd, temp_credentials_path = tempfile.mkstemp(suffix='.json')
         try:
-            # JSON文字列をパース
-            credentials_info = json.loads(GOOGLE_CREDENTIALS_JSON)
-            
-            # 認証情報の妥当性を確認
-            if 'type' not in credentials_info or credentials_info['type'] != 'service_account':
-                raise ValueError("無効なサービスアカウント認証情報です")
-            
-            # 一時ファイルとして作成（Render環境での権限問題を回避）
-            with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as temp_file:
-                json.dump(credentials_info, temp_file, indent=2)
-                temp_credentials_path = temp_file.name
-            
-            # 環境変数を更新
-            os.environ['GOOGLE_SHEETS_CREDENTIALS_FILE'] = temp_credentials_path
-            logger.info(f"認証情報ファイルを作成しました: {temp_credentials_path}")
-            
-            # ファイルの存在を確認
-            if os.path.exists(temp_credentials_path):
-                logger.info("認証情報ファイルの作成が確認されました")
-                return True
-            else:
-                logger.error("認証情報ファイルの作成に失敗しました")
-                return False
+            os.write(fd, raw_credentials)
+        finally:
+            os.close(fd)
+        
+        # 環境変数を更新
+        os.environ['GOOGLE_SHEETS_CREDENTIALS_FILE'] = temp_credentials_path
+        logger.info(f"認証情報ファイルを作成しました: {temp_credentials_path}")
+        
+        # ファイルの存在を確認
+        if os.path.exists(temp_credentials_path):
+            logger.info("認証情報ファイルの作成が確認されました")
+            return temp_credentials_path
+        else:
+            logger.error("認証情報ファイルの作成に失敗しました")
+            return None
+        
+    except Exception as e:
+        logger.error(f"credentials.jsonの生成に失敗しました: {e}")
+        return None
+
+# 設定検証・概要のキャッシュ（設定はプロセス内で不変なため、最初の呼び出し結果を使い回す）
+_VALIDATION_RESULT = None
+_CONFIG_SUMMARY = None
+
+# LINE Messaging API設定
+LINE_CHANNEL_ACCESS_TOKEN: Final = _E('LINE_CHANNEL_ACCESS_TOKEN')
+LINE_CHANNEL_SECRET: Final = _E('LINE_CHANNEL_SECRET')
+
+# Google Sheets API設定
+GOOGLE_SHEETS_CREDENTIALS_FILE: Final = _E('GOOGLE_SHEETS_CREDENTIALS_FILE', 'credentials.json')
+SPREADSHEET_ID: Final = _E('SPREADSHEET_ID')
+WORKSHEET_NAME: Final = _E('WORKSHEET_NAME', 'ポイント記録')
+# 書き込み待ちの記録を保存するSQLiteファイル（空文字の場合はメモリ上のみで保持）
+# 同じファイルシステム上でのプロセスの再起動にのみ対応（Renderではデプロイのたびにファイルが消えるため、
+# デプロイ前に追記できなかった記録は引き継がれない）
+OUTBOX_DB_PATH: Final = _E('OUTBOX_DB_PATH', 'sheets_outbox.db')
+
+# Flask設定
+FLASK_SECRET_KEY: Final = _E('FLASK_SECRET_KEY', 'default-secret-key-change-in-production')
+FLASK_ENV: Final = _E('FLASK_ENV', 'development')
+
+# アプリケーション設定
+DEBUG: Final = FLASK_ENV == 'development'
+HOST: Final = _E('HOST', '0.0.0.0')
+PORT: Final = int(_E('PORT', '5000'))
+
+@dataclass(frozen=True)
+class PointRule:
+    """ポイントルール"""
+    
+    __slots__ = ('points', 'message', 'description', 'template_parts')
+    
+    points: int
+    message: str
+    description: str
+    
+    def __post_init__(self):
+        # {points}の前後で分割したメッセージ（生成時に一度だけ作成）
+        object.__setattr__(self, 'template_parts', tuple(self.message.split('{points}')))
+    
+    def render(self, points: int) -> str:
+        """
+        メッセージの{points}を置き換えて返信メッセージを生成
+        
+        Args:
+            points: 付与ポイント
             
-        except Exception as e:
-            logger.error(f"credentials.jsonの生成に失敗しました: {e}")
-            return False
-    else:
-        logger.warning("GOOGLE_CREDENTIALS_JSONが設定されていません")
-        return False
+        Returns:
+            返信メッセージ
+        """
+        return str(points).join(self.template_parts)
+
+# ポイントシステム設定
+POINT_RULES: Final = {
+    '#宿題': PointRule(1, '宿題がんばったね！{points}pt追加したよ✨', '宿題を完了'),
+    '#スタスタ': PointRule(3, 'スタスタで運動できたね！{points}pt追加したよ💪', 'スタスタを完了'),
+    '#ごみ捨て': PointRule(5, 'ごみ捨てお疲れさま！{points}pt追加したよ🗑️', 'ごみ捨てを完了'),
+}
+
+# 履歴設定
+DEFAULT_HISTORY_LIMIT: Final = 10
 
-# 認証情報ファイルの作成
-credentials_created = create_credentials_file()
+# 100ptごと達成お祝いメッセージ設定
+CELEBRATION_MESSAGES: Final = {
+    100: [
+        "🎉 100pt達成おめでとう！君の努力が形になってるよ！✨",
+        "🌟 100ptゲット！毎日コツコツがんばってるね！すごいぞ！💪",
+        "🏆 100pt達成！君は本当に頑張り屋さんだね！この調子で続けよう！🎊"
+    ],
+    200: [
+        "🎉 200pt達成！すごいぞ！この調子でどんどんチャレンジしよう！",
+        "🚀 200pt達成！君のやる気がどんどんパワーアップしてるね！",
+        "🌈 200pt達成！毎日の積み重ねが力になってるよ！"
+    ],
+    300: [
+        "🏆 300pt達成！君の継続力は本当に素晴らしい！",
+        "🎊 300pt達成！ここまで続けられる君は本当にすごい！",
+        "💫 300pt達成！君の努力は必ず実を結ぶよ！"
+    ],
+    400: [
+        "🌟 400pt達成！毎日コツコツがんばってるね！",
+        "🎉 400pt達成！君の成長が目に見えてるよ！素晴らしい！",
+        "🚀 400pt達成！この調子でどんどん進もう！"
+    ],
+    500: [
+        "🚀 500pt達成！ここまで続けられる君は本当にすごい！",
+        "🏅 500pt達成！君の継続力は本物だね！",
+        "🎉 500pt達成！これからも一緒にがんばろう！"
+    ]
+}
+# それ以降（600pt, 700pt...）は500ptのメッセージを使い回します
 
 class Config:
-    """アプリケーション設定を管理するクラス"""
+    """アプリケーション設定を管理するクラス（モジュール定数への参照をまとめたもの）"""
+    
+    _ENV = _ENV
     
     # LINE Messaging API設定
-    LINE_CHANNEL_ACCESS_TOKEN = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
-    LINE_CHANNEL_SECRET = os.getenv('LINE_CHANNEL_SECRET')
+    LINE_CHANNEL_ACCESS_TOKEN = LINE_CHANNEL_ACCESS_TOKEN
+    LINE_CHANNEL_SECRET = LINE_CHANNEL_SECRET
     
     # Google Sheets API設定
-    GOOGLE_SHEETS_CREDENTIALS_FILE = os.getenv('GOOGLE_SHEETS_CREDENTIALS_FILE', 'credentials.json')
-    SPREADSHEET_ID = os.getenv('SPREADSHEET_ID')
-    WORKSHEET_NAME = os.getenv('WORKSHEET_NAME', 'ポイント記録')
+    GOOGLE_SHEETS_CREDENTIALS_FILE = GOOGLE_SHEETS_CREDENTIALS_FILE
+    SPREADSHEET_ID = SPREADSHEET_ID
+    WORKSHEET_NAME = WORKSHEET_NAME
+    OUTBOX_DB_PATH = OUTBOX_DB_PATH
     
     # Flask設定
-    FLASK_SECRET_KEY = os.getenv('FLASK_SECRET_KEY', 'default-secret-key-change-in-production')
-    FLASK_ENV = os.getenv('FLASK_ENV', 'development')
+    FLASK_SECRET_KEY = FLASK_SECRET_KEY
+    FLASK_ENV = FLASK_ENV
     
     # アプリケーション設定
-    DEBUG = FLASK_ENV == 'development'
-    HOST = os.getenv('HOST', '0.0.0.0')
-    PORT = int(os.getenv('PORT', 5000))
+    DEBUG = DEBUG
+    HOST = HOST
+    PORT = PORT
     
     # ポイントシステム設定
-    DEFAULT_POINT_RULES = {
-        '#宿題': {
-            'points': 1,
-            'message': '宿題がんばったね！{points}pt追加したよ✨',
-            'description': '宿題を完了'
-        },
-        '#スタスタ': {
-            'points': 3,
-            'message': 'スタスタで運動できたね！{points}pt追加したよ💪',
-            'description': 'スタスタを完了'
-        },
-        '#ごみ捨て': {
-            'points': 5,
-            'message': 'ごみ捨てお疲れさま！{points}pt追加したよ🗑️',
-            'description': 'ごみ捨てを完了'
-        }
-    }
-    
-    # 履歴設定
-    DEFAULT_HISTORY_LIMIT = 10
-    
-    # 100ptごと達成お祝いメッセージ設定
-    CELEBRATION_MESSAGES = {
-        100: [
-            "🎉 100pt達成おめでとう！君の努力が形になってるよ！✨",
-            "🌟 100ptゲット！毎日コツコツがんばってるね！すごいぞ！💪",
-            "🏆 100pt達成！君は本当に頑張り屋さんだね！この調子で続けよう！🎊"
-        ],
-        200: [
-            "🎉 200pt達成！すごいぞ！この調子でどんどんチャレンジしよう！",
-            "🚀 200pt達成！君のやる気がどんどんパワーアップしてるね！",
-            "🌈 200pt達成！毎日の積み重ねが力になってるよ！"
-        ],
-        300: [
-            "🏆 300pt達成！君の継続力は本当に素晴らしい！",
-            "🎊 300pt達成！ここまで続けられる君は本当にすごい！",
-            "💫 300pt達成！君の努力は必ず実を結ぶよ！"
-        ],
-        400: [
-            "🌟 400pt達成！毎日コツコツがんばってるね！",
-            "🎉 400pt達成！君の成長が目に見えてるよ！素晴らしい！",
-            "🚀 400pt達成！この調子でどんどん進もう！"
-        ],
-        500: [
-            "🚀 500pt達成！ここまで続けられる君は本当にすごい！",
-            "🏅 500pt達成！君の継続力は本物だね！",
-            "🎉 500pt達成！これからも一緒にがんばろう！"
-        ]
-    }
-    # それ以降（600pt, 700pt...）は500ptのメッセージを使い回します
+    DEFAULT_POINT_RULES = POINT_RULES
+    DEFAULT_HISTORY_LIMIT = DEFAULT_HISTORY_LIMIT
+    CELEBRATION_MESSAGES = CELEBRATION_MESSAGES
+    
+    @classmethod
+    def get_env(cls, key: str, default: Optional[str] = None) -> Optional[str]:
+        """
+        環境変数のスナップショットから値を取得
+        
+        Args:
+            key: 環境変数名
+            default: 未設定時のデフォルト値
+            
+        Returns:
+            環境変数の値
+        """
+        return cls._ENV.get(key, default)
+    
+    @classmethod
+    @functools.lru_cache(maxsize=1)
+    def credentials_path(cls) -> str:
+        """
+        Google API認証情報ファイルのパスを取得
+        
+        認証情報ファイルは最初の呼び出し時に作成されます（インポート時には作成しません）。
+        
+        Returns:
+            認証情報ファイルのパス
+        """
+        return _materialize_credentials() or cls.GOOGLE_SHEETS_CREDENTIALS_FILE
+    
+    @classmethod
+    def tag_pattern(cls, tags: Optional[Iterable[str]] = None) -> re.Pattern:
+        """
+        タグ検出用の正規表現を取得
+        
+        デフォルトのポイントルールと同じタグの組み合わせなら、インポート時に作成済みのパターンを返します。
+        
+        Args:
+            tags: タグの一覧（Noneの場合はデフォルトのポイントルールのタグ）
+            
+        Returns:
+            長いタグを優先してマッチする正規表現
+        """
+        if tags is None or frozenset(tags) == _DEFAULT_TAGS:
+            return _TAG_RE
+        return _compile_tag_pattern(tags)
+    
+    @classmethod
+    def match_tags(cls, text: str) -> List[Tuple[str, PointRule]]:
+        """
+        メッセージに含まれるデフォルトのポイントルールのタグを抽出
+        
+        Args:
+            text: 解析するメッセージ
+            
+        Returns:
+            (タグ, ポイントルール)のタプルのリスト（出現順、重複なし）
+        """
+        return [(tag, cls.DEFAULT_POINT_RULES[tag]) for tag in dict.fromkeys(_TAG_RE.findall(text))]
+    
+    @classmethod
+    def pick_celebration(cls, points: int) -> str:
+        """
+        達成ポイントに対応するお祝いメッセージをランダムに選択
+        
+        Args:
+            points: 達成したポイント（100pt単位）
+            
+        Returns:
+            お祝いメッセージ（100pt未満の場合は空文字）
+        """
+        idx = bisect.bisect_right(_TIER_KEYS, min(points, _TIER_KEYS[-1])) - 1
+        return random.choice(_TIER_MSGS[idx]) if idx >= 0 else ""
     
     @classmethod
     def validate_config(cls) -> Dict[str, Any]:
@@ -135,6 +291,10 @@ class Config:
         Returns:
             検証結果の辞書
         """
+        global _VALIDATION_RESULT
+        if _VALIDATION_RESULT is not None:
+            return _VALIDATION_RESULT
+        
         errors = []
         warnings = []
         
@@ -153,18 +313,19 @@ class Config:
             warnings.append("本番環境ではFLASK_SECRET_KEYを変更してください")
         
         # 認証情報の確認
-        if not GOOGLE_CREDENTIALS_JSON:
-            errors.append("GOOGLE_CREDENTIALS_JSONが設定されていません")
-        elif not credentials_created:
+        if not GOOGLE_CREDENTIALS_JSON and not GOOGLE_CREDENTIALS_BASE64:
+            errors.append("GOOGLE_CREDENTIALS_JSON（またはGOOGLE_CREDENTIALS_BASE64）が設定されていません")
+        elif _materialize_credentials() is None:
             errors.append("認証情報ファイルの作成に失敗しました")
-        elif not os.path.exists(cls.GOOGLE_SHEETS_CREDENTIALS_FILE):
-            errors.append(f"Google API認証情報ファイルが見つかりません: {cls.GOOGLE_SHEETS_CREDENTIALS_FILE}")
+        elif not os.path.exists(cls.credentials_path()):
+            errors.append(f"Google API認証情報ファイルが見つかりません: {cls.credentials_path()}")
         
-        return {
+        _VALIDATION_RESULT = {
             'valid': len(errors) == 0,
             'errors': errors,
             'warnings': warnings
         }
+        return _VALIDATION_RESULT
     
     @classmethod
     def get_config_summary(cls) -> Dict[str, Any]:
@@ -174,16 +335,29 @@ class Config:
         Returns:
             設定概要の辞書
         """
-        return {
+        global _CONFIG_SUMMARY
+        if _CONFIG_SUMMARY is not None:
+            return _CONFIG_SUMMARY
+        
+        _CONFIG_SUMMARY = {
             'flask_env': cls.FLASK_ENV,
             'debug': cls.DEBUG,
             'host': cls.HOST,
             'port': cls.PORT,
             'worksheet_name': cls.WORKSHEET_NAME,
-            'credentials_file': cls.GOOGLE_SHEETS_CREDENTIALS_FILE,
-            'credentials_created': credentials_created,
+            'credentials_file': cls.credentials_path(),
+            'credentials_created': _materialize_credentials() is not None,
             'line_configured': bool(cls.LINE_CHANNEL_ACCESS_TOKEN and cls.LINE_CHANNEL_SECRET),
             'sheets_configured': bool(cls.SPREADSHEET_ID),
-            'credentials_configured': bool(GOOGLE_CREDENTIALS_JSON),
+            'credentials_configured': bool(GOOGLE_CREDENTIALS_JSON or GOOGLE_CREDENTIALS_BASE64),
             'point_rules_count': len(cls.DEFAULT_POINT_RULES)
-        } 
\ No newline at end of file
+        }
+        return _CONFIG_SUMMARY
+
+# お祝いメッセージの段階（ポイント順）とメッセージをインポート時に一度だけ作成
+_TIER_KEYS = tuple(sorted(Config.CELEBRATION_MESSAGES))
+_TIER_MSGS = tuple(Config.CELEBRATION_MESSAGES[k] for k in _TIER_KEYS)
+
+# デフォルトのポイントルールのタグ検出用パターン（PointSystemもルールが変わらない限りこれを使う）
+_DEFAULT_TAGS = frozenset(Config.DEFAULT_POINT_RULES)
+_TAG_RE = _compile_tag_pattern(_DEFAULT_TAGS)
@@ -5,100 +5,138 @@ Renderデプロイ時の問題解決に使用します。
 """
 
 import os
-import json
+import sys
+import base64
+import orjson
 import tempfile
-from dotenv import load_dotenv
+from pathlib import Path
+
+def load_env_file():
+    """.envファイルから環境変数を読み込み（Render等では省略）"""
+    if os.environ.get('RENDER') is not None or os.environ.get('GAE_ENV') is not None:
+        return
+    try:
+        if Path('.env').is_file():
+            from dotenv import load_dotenv
+            load_dotenv()
+    except ImportError:
+        pass
+
+def read_raw_credentials(google_credentials_json, google_credentials_base64):
+    """
+    環境変数から認証情報のバイト列を取得
+    
+    GOOGLE_CREDENTIALS_JSONを優先し、未設定の場合はGOOGLE_CREDENTIALS_BASE64をデコードします。
+    Base64はデコードしたバイト列をそのままorjsonに渡すため、文字列への変換は行いません。
+    """
+    if google_credentials_json:
+        return google_credentials_json.encode('utf-8')
+    return base64.b64decode(google_credentials_base64)
 
 def debug_credentials():
     """認証情報のデバッグ"""
-    print("🔍 認証情報デバッグツール")
-    print("="*50)
+    # 出力は行ごとにprintせず、まとめて一度に書き出す
+    lines = []
+    try:
+        return _run_debug_checks(lines.append)
+    finally:
+        sys.stdout.write("\n".join(lines) + "\n")
+
+def _run_debug_checks(emit):
+    """認証情報の各チェックを実行し、結果の行をemitに渡す"""
+    emit("🔍 認証情報デバッグツール")
+    emit("="*50)
     
     # 環境変数の読み込み
-    load_dotenv()
+    load_env_file()
     
     # 環境変数の確認
-    google_credentials_json = os.getenv('GOOGLE_CREDENTIALS_JSON')
-    credentials_file_path = os.getenv('GOOGLE_SHEETS_CREDENTIALS_FILE', 'credentials.json')
+    google_credentials_json = os.environ.get('GOOGLE_CREDENTIALS_JSON')
+    google_credentials_base64 = os.environ.get('GOOGLE_CREDENTIALS_BASE64')
+    credentials_file_path = os.environ.get('GOOGLE_SHEETS_CREDENTIALS_FILE', 'credentials.json')
     
-    print(f"1. 環境変数の確認:")
-    print(f"   GOOGLE_CREDENTIALS_JSON: {'設定済み' if google_credentials_json else '未設定'}")
-    print(f"   GOOGLE_SHEETS_CREDENTIALS_FILE: {credentials_file_path}")
+    emit(f"1. 環境変数の確認:")
+    emit(f"   GOOGLE_CREDENTIALS_JSON: {'設定済み' if google_credentials_json else '未設定'}")
+    emit(f"   GOOGLE_CREDENTIALS_BASE64: {'設定済み' if google_credentials_base64 else '未設定'}")
+    emit(f"   GOOGLE_SHEETS_CREDENTIALS_FILE: {credentials_file_path}")
     
-    if not google_credentials_json:
-        print("❌ GOOGLE_CREDENTIALS_JSONが設定されていません")
+    if not google_credentials_json and not google_credentials_base64:
+        emit("❌ GOOGLE_CREDENTIALS_JSON（またはGOOGLE_CREDENTIALS_BASE64）が設定されていません")
         return False
     
     # JSON文字列のテスト
-    print(f"\n2. JSON文字列のテスト:")
+    emit(f"\n2. JSON文字列のテスト:")
     try:
         # JSONパースのテスト
-        credentials_info = json.loads(google_credentials_json)
-        print("✅ JSONパース成功")
+        raw_credentials = read_raw_credentials(google_credentials_json, google_credentials_base64)
+        credentials_info = orjson.loads(raw_credentials)
+        emit("✅ JSONパース成功")
         
         # 認証情報の妥当性確認
         if 'type' in credentials_info:
-            print(f"✅ 認証情報タイプ: {credentials_info['type']}")
+            emit(f"✅ 認証情報タイプ: {credentials_info['type']}")
         else:
-            print("❌ 認証情報タイプが見つかりません")
+            emit("❌ 認証情報タイプが見つかりません")
             return False
         
         if credentials_info.get('type') != 'service_account':
-            print("❌ サービスアカウント認証情報ではありません")
+            emit("❌ サービスアカウント認証情報ではありません")
             return False
         
         if 'client_email' in credentials_info:
-            print(f"✅ クライアントメール: {credentials_info['client_email']}")
+            emit(f"✅ クライアントメール: {credentials_info['client_email']}")
         else:
-            print("❌ クライアントメールが見つかりません")
+            emit("❌ クライアントメールが見つかりません")
             return False
         
         if 'project_id' in credentials_info:
-            print(f"✅ プロジェクトID: {credentials_info['project_id']}")
+            emit(f"✅ プロジェクトID: {credentials_info['project_id']}")
         else:
-            print("❌ プロジェクトIDが見つかりません")
+            emit("❌ プロジェクトIDが見つかりません")
             return False
         
     except Exception as e:
-        print(f"❌ JSONパースに失敗: {e}")
+        emit(f"❌ JSONパースに失敗: {e}")
         return False
     
     # ファイル作成のテスト
-    print(f"\n3. 認証情報ファイル作成のテスト:")
+    emit(f"\n3. 認証情報ファイル作成のテスト:")
     try:
-        # 一時ファイルとして作成
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as temp_file:
-            json.dump(credentials_info, temp_file, indent=2)
-            temp_credentials_path = temp_file.name
+        # 一時ファイルとして作成（アプリ本体と同じく元のJSONをそのまま書き出す）
+        fd, temp_credentials_path = tempfile.mkstemp(suffix='.json')
+        try:
+            os.write(fd, raw_credentials)
+        finally:
+            os.close(fd)
         
-        print(f"✅ 一時ファイル作成成功: {temp_credentials_path}")
+        emit(f"✅ 一時ファイル作成成功: {temp_credentials_path}")
         
         # ファイルの存在確認
         if os.path.exists(temp_credentials_path):
-            print("✅ ファイル存在確認成功")
+            emit("✅ ファイル存在確認成功")
             
             # ファイルサイズの確認
             file_size = os.path.getsize(temp_credentials_path)
-            print(f"✅ ファイルサイズ: {file_size} bytes")
+            emit(f"✅ ファイルサイズ: {file_size} bytes")
             
             # ファイル内容の読み込みテスト
-            with open(temp_credentials_path, 'r') as f:
-                test_content = json.load(f)
-                print("✅ ファイル読み込みテスト成功")
+            with open(temp_credentials_path, 'rb') as f:
+                test_content = orjson.loads(f.read())
+                emit("✅ ファイル読み込みテスト成功")
             
             # 一時ファイルの削除
             os.unlink(temp_credentials_path)
-            print("✅ 一時ファイル削除完了")
+            emit("✅ 一時ファイル削除完了")
             
         else:
-            print("❌ ファイル存在確認失敗")
+            emit("❌ ファイル存在確認失敗")
             return False
         
     except Exception as e:
-        print(f"❌ ファイル作成テストに失敗: {e}")
+        emit(f"❌ ファイル作成テストに失敗: {e}")
         return False
     
-    print(f"\n✅ 全てのテストが成功しました！")
+    emit(f"\n✅ 全てのテストが成功しました！")
     return True
 
 def restore_credentials():
@@ -106,25 +144,29 @@ def restore_credentials():
     print("\n🔄 認証情報ファイルの復元")
     print("="*50)
     
-    load_dotenv()
-    google_credentials_json = os.getenv('GOOGLE_CREDENTIALS_JSON')
+    load_env_file()
+    google_credentials_json = os.environ.get('GOOGLE_CREDENTIALS_JSON')
+    google_credentials_base64 = os.environ.get('GOOGLE_CREDENTIALS_BASE64')
     
-    if not google_credentials_json:
-        print("❌ GOOGLE_CREDENTIALS_JSONが設定されていません")
+    if not google_credentials_json and not google_credentials_base64:
+        print("❌ GOOGLE_CREDENTIALS_JSON（またはGOOGLE_CREDENTIALS_BASE64）が設定されていません")
         return False
     
     try:
-        # JSON文字列をパース
-        credentials_info = json.loads(google_credentials_json)
+        # 認証情報をパース
+        raw_credentials = read_raw_credentials(google_credentials_json, google_credentials_base64)
+        credentials_info = orjson.loads(raw_credentials)
         
         # 認証情報の妥当性を確認
         if 'type' not in credentials_info or credentials_info['type'] != 'service_account':
             raise ValueError("無効なサービスアカウント認証情報です")
         
-        # 一時ファイルとして作成
-        with tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False) as temp_file:
-            json.dump(credentials_info, temp_file, indent=2)
-            temp_credentials_path = temp_file.name
+        # 一時ファイルとして作成（元のJSONをそのまま書き出す）
+        fd, temp_credentials_path = tempfile.mkstemp(suffix='.json')
+        try:
+            os.write(fd, raw_credentials)
+        finally:
+            os.close(fd)
         
         # 環境変数を更新
         os.environ['GOOGLE_SHEETS_CREDENTIALS_FILE'] = temp_credentials_path
@@ -157,7 +199,7 @@ def main():
                 print("❌ 復元に失敗しました")
     else:
         print("\n❌ デバッグ結果: 認証情報に問題があります")
-        print("環境変数 GOOGLE_CREDENTIALS_JSON を確認してください")
+        print("環境変数 GOOGLE_CREDENTIALS_JSON（またはGOOGLE_CREDENTIALS_BASE64）を確認してください")
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -4,7 +4,7 @@ Google認証情報（credentials.json）をJSON文字列として出力するス
 Renderデプロイ用の環境変数設定に使用します。
 """
 
-import json
+import orjson
 import os
 import sys
 
@@ -20,28 +20,30 @@ def encode_credentials():
     
     try:
         # ファイルを読み込み
-        with open('credentials.json', 'r', encoding='utf-8') as f:
-            credentials_data = json.load(f)
+        with open('credentials.json', 'rb') as f:
+            credentials_data = orjson.loads(f.read())
         
         # 認証情報の妥当性を確認
         if 'type' not in credentials_data or credentials_data['type'] != 'service_account':
             print("❌ 無効なサービスアカウント認証情報です")
             return False
         
-        # JSON文字列として出力
-        credentials_json = json.dumps(credentials_data, separators=(',', ':'))
+        # JSON文字列として出力（バイト列のまま扱い、文字列への変換は行わない）
+        credentials_json = orjson.dumps(credentials_data)
         
         print("✅ credentials.jsonのJSON文字列変換が完了しました")
         print("\n" + "="*50)
         print("以下の文字列をGOOGLE_CREDENTIALS_JSON環境変数に設定してください：")
         print("="*50)
-        print(credentials_json)
+        sys.stdout.flush()
+        sys.stdout.buffer.write(credentials_json + b"\n")
+        sys.stdout.buffer.flush()
         print("="*50)
         
         # ファイルに保存（オプション）
         save_to_file = input("\nこの文字列をencoded_credentials.txtに保存しますか？ (y/n): ").lower()
         if save_to_file == 'y':
-            with open('encoded_credentials.txt', 'w') as f:
+            with open('encoded_credentials.txt', 'wb') as f:
                 f.write(credentials_json)
             print("✅ encoded_credentials.txtに保存しました")
         
@@ -1,8 +1,12 @@
 import os
+import base64
+import hashlib
+import hmac
 import logging
-import random
+import atexit
 from flask import Flask, request, abort, jsonify
 from linebot import LineBotApi, WebhookHandler
+from linebot.webhook import SignatureValidator
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
 
@@ -22,6 +26,33 @@ app.secret_key = Config.FLASK_SECRET_KEY
 line_bot_api = LineBotApi(Config.LINE_CHANNEL_ACCESS_TOKEN)
 handler = WebhookHandler(Config.LINE_CHANNEL_SECRET)
 
+
+class PrekeyedSignatureValidator(SignatureValidator):
+    """チャネルシークレットで初期化済みのHMACを複製して署名を検証するバリデーター"""
+    
+    def __init__(self, channel_secret: str):
+        super().__init__(channel_secret)
+        self._hmac_prototype = hmac.new(self.channel_secret, digestmod=hashlib.sha256)
+    
+    def validate(self, body: str, signature: str) -> bool:
+        """
+        署名を検証
+        
+        Args:
+            body: リクエストボディ
+            signature: X-Line-Signatureの値
+            
+        Returns:
+            署名が一致する場合True
+        """
+        mac = self._hmac_prototype.copy()
+        mac.update(body.encode('utf-8'))
+        return hmac.compare_digest(signature.encode('utf-8'), base64.b64encode(mac.digest()))
+
+
+# 署名検証はリクエストごとに鍵を設定し直さず、初期化済みのHMACを使い回す
+handler.parser.signature_validator = PrekeyedSignatureValidator(Config.LINE_CHANNEL_SECRET)
+
 # ポイントシステムとスプレッドシートハンドラーの初期化
 point_system = PointSystem()
 sheets_handler = None
@@ -36,24 +67,34 @@ def initialize_sheets_handler():
             logger.warning("Google Sheets設定が不完全です。スプレッドシート機能は無効化されます。")
             return False
         
-        logger.info(f"認証情報ファイル: {Config.GOOGLE_SHEETS_CREDENTIALS_FILE}")
+        # 認証情報ファイルはここで初めて作成される
+        credentials_file = Config.credentials_path()
+        logger.info(f"認証情報ファイル: {credentials_file}")
         logger.info(f"スプレッドシートID: {Config.SPREADSHEET_ID}")
         logger.info(f"ワークシート名: {Config.WORKSHEET_NAME}")
         
         # 認証情報ファイルの存在確認
-        if os.path.exists(Config.GOOGLE_SHEETS_CREDENTIALS_FILE):
+        if os.path.exists(credentials_file):
             logger.info("認証情報ファイルが存在します")
         else:
-            logger.warning(f"認証情報ファイルが見つかりません: {Config.GOOGLE_SHEETS_CREDENTIALS_FILE}")
+            logger.warning(f"認証情報ファイルが見つかりません: {credentials_file}")
         
         sheets_handler = SheetsHandler(
-            Config.GOOGLE_SHEETS_CREDENTIALS_FILE, 
+            credentials_file, 
             Config.SPREADSHEET_ID, 
-            Config.WORKSHEET_NAME
+            Config.WORKSHEET_NAME,
+            outbox_path=Config.OUTBOX_DB_PATH or None
         )
+        # 終了時に書き込み待ちの記録を追記する
+        atexit.register(sheets_handler.flush)
         
         # スプレッドシートの初期化
         if sheets_handler.initialize_sheet():
+            # 前回追記できなかった行を先に追記する（合計シートに反映される前に読み込まないように）
+            # 追記できなかった場合は、再送されるまで合計ポイントを読み込んでおかない
+            if sheets_handler.flush():
+                # 既存ユーザーの合計ポイントをまとめて読み込んでおく（最初のメッセージでの読み取りを省略）
+                sheets_handler.get_totals_bulk()
             logger.info("スプレッドシートハンドラーの初期化が完了しました")
             return True
         else:
@@ -77,7 +118,7 @@ def callback():
 
     # リクエストボディを取得
     body = request.get_data(as_text=True)
-    logger.info("Request body: " + body)
+    logger.debug("Request body: %s", body)
 
     try:
         # 署名を検証し、問題なければhandleに定義されている関数を呼び出す
@@ -88,54 +129,70 @@ def callback():
 
     return 'OK'
 
+def _handle_help(event, user_id: str):
+    """ヘルプコマンドの処理"""
+    logger.info("ヘルプコマンドを処理中...")
+    help_message = point_system.get_help_message()
+    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=help_message))
+    logger.info("ヘルプメッセージを送信しました")
+
+def _handle_point(event, user_id: str):
+    """ポイント確認コマンドの処理"""
+    logger.info("ポイント確認コマンドを処理中...")
+    if sheets_handler:
+        total_points = sheets_handler.get_total_points(user_id)
+        response_message = f"現在の合計ポイント: {total_points}pt 🎯"
+    else:
+        response_message = "スプレッドシートに接続できません😅\n設定を確認してください。"
+    
+    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_message))
+    logger.info("ポイント確認メッセージを送信しました")
+
+def _handle_history(event, user_id: str):
+    """履歴確認コマンドの処理"""
+    logger.info("履歴確認コマンドを処理中...")
+    if sheets_handler:
+        history = sheets_handler.get_user_history(user_id, limit=Config.DEFAULT_HISTORY_LIMIT)
+        if history:
+            response_message = "📋 最近の行動履歴：\n" + "\n".join(
+                f"• {record['action']} (+{record['points']}pt) - {record['timestamp']}" for record in history
+            )
+        else:
+            response_message = "まだ行動履歴がありません😊"
+    else:
+        response_message = "スプレッドシートに接続できません😅\n設定を確認してください。"
+    
+    line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_message))
+    logger.info("履歴確認メッセージを送信しました")
+
+# コマンド（小文字化済み）とハンドラーの対応表
+HELP_COMMANDS = frozenset({'#help', '#ヘルプ', 'help', 'ヘルプ'})
+POINT_COMMANDS = frozenset({'#ポイント', '#point', 'ポイント', 'point'})
+HISTORY_COMMANDS = frozenset({'#履歴', '#history', '履歴', 'history'})
+COMMAND_HANDLERS = {
+    **dict.fromkeys(HELP_COMMANDS, _handle_help),
+    **dict.fromkeys(POINT_COMMANDS, _handle_point),
+    **dict.fromkeys(HISTORY_COMMANDS, _handle_history),
+}
+
 @handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
     """テキストメッセージの処理"""
     try:
+        # 何度も参照する属性はローカル変数に束縛しておく
         user_id = event.source.user_id
         message_text = event.message.text
+        reply_token = event.reply_token
+        reply_message = line_bot_api.reply_message
+        sheets = sheets_handler
         
-        logger.info(f"受信メッセージ: {message_text} (ユーザー: {user_id})")
-        logger.info(f"sheets_handler初期化状態: {sheets_handler is not None}")
+        logger.debug("受信メッセージ: %s (ユーザー: %s)", message_text, user_id)
+        logger.info(f"sheets_handler初期化状態: {sheets is not None}")
         
-        # ヘルプコマンドの処理
-        if message_text.lower() in ['#help', '#ヘルプ', 'help', 'ヘルプ']:
-            logger.info("ヘルプコマンドを処理中...")
-            help_message = point_system.get_help_message()
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=help_message))
-            logger.info("ヘルプメッセージを送信しました")
-            return
-        
-        # ポイント確認コマンドの処理
-        if message_text.lower() in ['#ポイント', '#point', 'ポイント', 'point']:
-            logger.info("ポイント確認コマンドを処理中...")
-            if sheets_handler:
-                total_points = sheets_handler.get_total_points(user_id)
-                response_message = f"現在の合計ポイント: {total_points}pt 🎯"
-            else:
-                response_message = "スプレッドシートに接続できません😅\n設定を確認してください。"
-            
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_message))
-            logger.info("ポイント確認メッセージを送信しました")
-            return
-        
-        # 履歴確認コマンドの処理
-        if message_text.lower() in ['#履歴', '#history', '履歴', 'history']:
-            logger.info("履歴確認コマンドを処理中...")
-            if sheets_handler:
-                history = sheets_handler.get_user_history(user_id, limit=Config.DEFAULT_HISTORY_LIMIT)
-                if history:
-                    history_lines = ["📋 最近の行動履歴："]
-                    for record in history:
-                        history_lines.append(f"• {record['action']} (+{record['points']}pt) - {record['timestamp']}")
-                    response_message = "\n".join(history_lines)
-                else:
-                    response_message = "まだ行動履歴がありません😊"
-            else:
-                response_message = "スプレッドシートに接続できません😅\n設定を確認してください。"
-            
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_message))
-            logger.info("履歴確認メッセージを送信しました")
+        # コマンドの処理（小文字化は1回だけ行い、対応するハンドラーに振り分ける）
+        command_handler = COMMAND_HANDLERS.get(message_text.lower())
+        if command_handler is not None:
+            command_handler(event, user_id)
             return
         
         # ポイントルールの解析
@@ -147,71 +204,52 @@ def handle_message(event):
             # ポイント対象の行動が見つからない場合
             logger.info("ポイント対象の行動が見つかりませんでした")
             response_message = "ポイント対象の行動が見つからなかったよ😅\n\n" + point_system.get_help_message()
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_message))
+            reply_message(reply_token, TextSendMessage(text=response_message))
             logger.info("ヘルプメッセージを送信しました")
             return
         
         # スプレッドシートハンドラーが初期化されていない場合
-        if not sheets_handler:
+        if not sheets:
             logger.warning("スプレッドシートハンドラーが初期化されていません")
             response_message = "申し訳ありません。スプレッドシートの設定が完了していません😅\n\n設定を確認してください。"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_message))
+            reply_message(reply_token, TextSendMessage(text=response_message))
             logger.info("エラーメッセージを送信しました")
             return
         
-        # 各マッチしたルールに対してポイントを記録
+        # マッチしたルールのポイントを合計に反映し、記録はバックグラウンドで行う
         logger.info("ポイント記録を開始...")
-        total_points_earned = 0
-        recorded_actions = []
-        
-        for keyword, points, _ in matches:
-            action_description = point_system.get_point_rule(keyword)['description']
-            logger.info(f"記録中: {action_description} (+{points}pt)")
-            
-            # スプレッドシートに記録
-            if sheets_handler.record_action(user_id, action_description, points):
-                total_points_earned += points
-                recorded_actions.append(f"{action_description} (+{points}pt)")
-                logger.info(f"記録成功: {action_description}")
-            else:
-                logger.error(f"行動記録に失敗: {action_description}")
+        actions = [(description, points) for _, points, _, description in matches]
+        total_points_earned = sum(points for _, points in actions)
+        recorded_actions = [f"{action_description} (+{points}pt)" for action_description, points in actions]
         
-        # 現在の合計ポイントを取得
-        current_total = sheets_handler.get_total_points(user_id)
+        # 記録前の合計ポイント（記録完了を待たずに次のメッセージへ反映されるよう先に加算）
+        previous_total = sheets.reserve_points(user_id, total_points_earned)
+        if previous_total is None:
+            # 合計ポイントを読み取れない場合は、誤った合計で記録しないよう記録を見送る
+            logger.error("合計ポイントの取得に失敗したため記録を中止しました")
+            reply_message(reply_token, TextSendMessage(text="ポイントの記録に失敗しました😅"))
+            return
+        current_total = previous_total + total_points_earned
         logger.info(f"現在の合計ポイント: {current_total}pt")
         
+        # スプレッドシートへの記録は書き込み待ちに追加し、他の記録とまとめてバックグラウンドで追記
+        future = sheets.queue_actions(user_id, actions, previous_total)
+        future.add_done_callback(
+            lambda f: _on_actions_recorded(f, sheets, user_id, len(actions), previous_total, current_total)
+        )
+        
         # 返信メッセージの生成
-        if total_points_earned > 0:
-            if len(recorded_actions) == 1:
-                response_message = f"{recorded_actions[0]} がんばったね！✨（合計：{current_total}pt）"
-            else:
-                actions_text = "、".join(recorded_actions)
-                response_message = f"{actions_text} たくさんがんばったね！🎉（合計：{current_total}pt）"
+        if len(recorded_actions) == 1:
+            response_message = f"{recorded_actions[0]} がんばったね！✨（合計：{current_total}pt）"
         else:
-            response_message = "ポイントの記録に失敗しました😅"
+            actions_text = "、".join(recorded_actions)
+            response_message = f"{actions_text} たくさんがんばったね！🎉（合計：{current_total}pt）"
         
         # LINEに返信
         logger.info(f"返信メッセージを送信: {response_message}")
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=response_message))
+        reply_message(reply_token, TextSendMessage(text=response_message))
         logger.info("返信メッセージの送信が完了しました")
         
-        # 100ptごと達成をチェック（前回の合計ポイントと比較）
-        previous_total = current_total - total_points_earned
-        prev_celebrate = previous_total // 100
-        curr_celebrate = current_total // 100
-        if curr_celebrate > prev_celebrate and curr_celebrate >= 1:
-            celebrate_pt = curr_celebrate * 100
-            if celebrate_pt in Config.CELEBRATION_MESSAGES:
-                celebration_message = random.choice(Config.CELEBRATION_MESSAGES[celebrate_pt])
-            else:
-                # 500pt以降は500ptのメッセージを使い回す
-                celebration_message = random.choice(Config.CELEBRATION_MESSAGES[500])
-            try:
-                line_bot_api.push_message(user_id, TextSendMessage(text=celebration_message))
-                logger.info(f"{celebrate_pt}pt達成お祝いメッセージを送信: {user_id}")
-            except Exception as e:
-                logger.error(f"お祝いメッセージ送信エラー: {e}")
-        
     except Exception as e:
         logger.error(f"メッセージ処理エラー: {e}")
         import traceback
@@ -222,22 +260,74 @@ def handle_message(event):
         except:
             pass
 
+def _on_actions_recorded(future, sheets: SheetsHandler, user_id: str, action_count: int,
+                         previous_total: int, current_total: int):
+    """
+    バックグラウンドでの記録完了時の処理
+    
+    Args:
+        future: queue_actionsのFuture
+        sheets: 記録を受け付けたスプレッドシートハンドラー
+        user_id: ユーザーID
+        action_count: 記録した行動の件数
+        previous_total: 記録前の合計ポイント
+        current_total: 記録後の合計ポイント
+    """
+    try:
+        recorded = future.result()
+    except Exception as e:
+        logger.error(f"行動記録エラー: {e}")
+        recorded = False
+    
+    if not recorded:
+        # 先に反映したこの記録の分だけ合計ポイントから差し引き、失敗したことをユーザーに知らせる
+        logger.error(f"行動記録に失敗: {action_count}件")
+        sheets.release_points(user_id, current_total - previous_total)
+        try:
+            line_bot_api.push_message(user_id, TextSendMessage(text="ポイントの記録に失敗しました😅"))
+        except Exception as e:
+            logger.error(f"失敗通知の送信エラー: {e}")
+        return
+    
+    logger.info(f"記録成功: {action_count}件")
+    
+    # 100ptごと達成をチェック（100pt未満なら割り算もせずに終了）
+    if current_total < 100:
+        return
+    curr_celebrate = current_total // 100
+    if curr_celebrate > previous_total // 100:
+        celebrate_pt = curr_celebrate * 100
+        # 500pt以降は500ptのメッセージを使い回す
+        celebration_message = Config.pick_celebration(celebrate_pt)
+        try:
+            line_bot_api.push_message(user_id, TextSendMessage(text=celebration_message))
+            logger.info(f"{celebrate_pt}pt達成お祝いメッセージを送信: {user_id}")
+        except Exception as e:
+            logger.error(f"お祝いメッセージ送信エラー: {e}")
+
 @app.route("/health", methods=['GET'])
 def health_check():
     """ヘルスチェックエンドポイント"""
     return {"status": "healthy", "message": "LINE Point System is running"}
 
+# /configの応答本文（設定とスプレッドシートの接続状態は起動後に変わらないため初回に生成して使い回す）
+_config_status_body = None
+
 @app.route("/config", methods=['GET'])
 def config_status():
     """設定状況を確認するエンドポイント"""
-    validation = Config.validate_config()
-    summary = Config.get_config_summary()
+    global _config_status_body
+    if _config_status_body is None:
+        validation = Config.validate_config()
+        summary = Config.get_config_summary()
+        
+        _config_status_body = jsonify({
+            "validation": validation,
+            "summary": summary,
+            "sheets_connected": sheets_handler is not None
+        }).get_data()
     
-    return jsonify({
-        "validation": validation,
-        "summary": summary,
-        "sheets_connected": sheets_handler is not None
-    })
+    return app.response_class(_config_status_body, mimetype='application/json')
 
 @app.route("/", methods=['GET'])
 def index():
@@ -1,7 +1,7 @@
 from typing import Dict, List, Optional, Tuple
 import re
 import logging
-from config import Config
+from config import Config, PointRule
 
 logger = logging.getLogger(__name__)
 
@@ -10,7 +10,14 @@ class PointSystem:
     
     def __init__(self):
         """初期化時にデフォルトのポイントルールを設定"""
-        self.point_rules = Config.DEFAULT_POINT_RULES.copy()
+        self.point_rules: Dict[str, PointRule] = dict(Config.DEFAULT_POINT_RULES)
+        # キーワード検出用の正規表現・整形済みメッセージ・ヘルプメッセージのキャッシュ
+        # （ルール変更時にまとめて再構築）
+        self._pattern: Optional[re.Pattern] = None
+        self._match_entries: Dict[str, Tuple[str, int, str, str]] = {}
+        self._help_message = ""
+        self._first_chars: frozenset = frozenset()
+        self._dirty = True
     
     def add_point_rule(self, keyword: str, points: int, message: str, description: str = ""):
         """
@@ -22,11 +29,8 @@ class PointSystem:
             message: 返信メッセージ（{points}プレースホルダー使用可能）
             description: ルールの説明
         """
-        self.point_rules[keyword] = {
-            'points': points,
-            'message': message,
-            'description': description
-        }
+        self.point_rules[keyword] = PointRule(points, message, description)
+        self._dirty = True
         logger.info(f"新しいポイントルールを追加: {keyword} ({points}pt)")
     
     def remove_point_rule(self, keyword: str) -> bool:
@@ -41,11 +45,12 @@ class PointSystem:
         """
         if keyword in self.point_rules:
             del self.point_rules[keyword]
+            self._dirty = True
             logger.info(f"ポイントルールを削除: {keyword}")
             return True
         return False
     
-    def get_point_rule(self, keyword: str) -> Optional[Dict]:
+    def get_point_rule(self, keyword: str) -> Optional[PointRule]:
         """
         指定されたキーワードのポイントルールを取得
         
@@ -57,7 +62,7 @@ class PointSystem:
         """
         return self.point_rules.get(keyword)
     
-    def get_all_rules(self) -> Dict[str, Dict]:
+    def get_all_rules(self) -> Dict[str, PointRule]:
         """
         全てのポイントルールを取得
         
@@ -66,7 +71,26 @@ class PointSystem:
         """
         return self.point_rules.copy()
     
-    def parse_message(self, message: str) -> List[Tuple[str, int, str]]:
+    def _rebuild_caches(self):
+        """ルールから検出用の正規表現・先頭文字・整形済みメッセージ・ヘルプメッセージを再構築"""
+        if self.point_rules:
+            # 全キーワードを1つの正規表現にまとめる（長いキーワードを優先）
+            # デフォルトのルールのままなら、Configで作成済みのパターンを共有する
+            self._pattern = Config.tag_pattern(self.point_rules)
+        else:
+            self._pattern = None
+        # キーワードの先頭文字（どれも含まないメッセージは走査せずに除外する）
+        self._first_chars = frozenset(keyword[0] for keyword in self.point_rules if keyword)
+        
+        # ポイントはルールごとに固定なので、返信メッセージも事前に整形しておく
+        self._match_entries = {
+            keyword: (keyword, rule.points, rule.render(rule.points), rule.description)
+            for keyword, rule in self.point_rules.items()
+        }
+        self._help_message = self._build_help_message()
+        self._dirty = False
+    
+    def parse_message(self, message: str) -> List[Tuple[str, int, str, str]]:
         """
         メッセージを解析してポイントルールにマッチするものを抽出
         
@@ -74,17 +98,23 @@ class PointSystem:
             message: 解析するメッセージ
             
         Returns:
-            (キーワード, ポイント, メッセージ)のタプルのリスト
+            (キーワード, ポイント, メッセージ, 説明)のタプルのリスト
         """
-        matches = []
+        if self._dirty:
+            self._rebuild_caches()
+        if self._pattern is None:
+            return []
         
-        for keyword, rule in self.point_rules.items():
-            if keyword in message:
-                points = rule['points']
-                response_message = rule['message'].format(points=points)
-                matches.append((keyword, points, response_message))
+        # キーワードの先頭文字が1つも含まれていなければマッチしない
+        if self._first_chars.isdisjoint(message):
+            return []
+        
+        # メッセージを一度だけ走査してキーワードを検出
+        found = set(self._pattern.findall(message))
+        if not found:
+            return []
         
-        return matches
+        return [self._match_entries[keyword] for keyword in self.point_rules if keyword in found]
     
     def get_total_points_for_message(self, message: str) -> int:
         """
@@ -97,9 +127,9 @@ class PointSystem:
             合計ポイント
         """
         matches = self.parse_message(message)
-        return sum(points for _, points, _ in matches)
+        return sum(points for _, points, _, _ in matches)
     
-    def format_response_message(self, matches: List[Tuple[str, int, str]], total_points: int) -> str:
+    def format_response_message(self, matches: List[Tuple[str, int, str, str]], total_points: int) -> str:
         """
         返信メッセージをフォーマット
         
@@ -115,18 +145,29 @@ class PointSystem:
         
         # 複数のルールにマッチした場合の処理
         if len(matches) == 1:
-            keyword, points, message = matches[0]
+            keyword, points, message, _ = matches[0]
             return f"{message}（合計：{total_points}pt）"
         else:
             # 複数マッチの場合は個別メッセージを結合
             messages = []
-            for keyword, points, message in matches:
+            for keyword, points, message, _ in matches:
                 messages.append(f"{message}")
             
             combined_message = " ".join(messages)
             return f"{combined_message}（合計：{total_points}pt）"
     
     def get_help_message(self) -> str:
+        """
+        ヘルプメッセージを取得（ルール変更がない限りキャッシュを返す）
+        
+        Returns:
+            ヘルプメッセージ
+        """
+        if self._dirty:
+            self._rebuild_caches()
+        return self._help_message
+    
+    def _build_help_message(self) -> str:
         """
         ヘルプメッセージを生成
         
@@ -139,10 +180,10 @@ class PointSystem:
         help_lines = ["📝 ポイント対象の行動一覧："]
         
         for keyword, rule in self.point_rules.items():
-            points = rule['points']
-            description = rule['description'] or keyword
+            points = rule.points
+            description = rule.description or keyword
             help_lines.append(f"• {keyword} → {points}pt ({description})")
         
         help_lines.append("\n💡 メッセージに上記のキーワードを含めて送信するとポイントが付与されます！")
         
-        return "\n".join(help_lines) 
\ No newline at end of file
+        return "\n".join(help_lines)
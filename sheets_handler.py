@@ -1,20 +1,73 @@
 import os
+import re
 import json
-from datetime import datetime
-from typing import Dict, List, Optional, Tuple
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
+import hashlib
+import time
+import random
+import sqlite3
+import threading
+from concurrent.futures import Future
+from typing import TYPE_CHECKING, Any, Dict, Iterator, List, Optional, Tuple
 from googleapiclient.errors import HttpError
+from config import Config
+
+# 認証・APIクライアント関連のモジュールは読み込みに時間がかかるため、認証時に読み込む
+if TYPE_CHECKING:
+    from google.oauth2.service_account import Credentials
 import logging
 
 # ログ設定
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# 合計ポイントのキャッシュ有効期間（秒）
+TOTALS_CACHE_TTL = 60
+
+# Sheets APIへのリクエストのタイムアウト（秒）
+HTTP_TIMEOUT = 30
+
+# 再試行するHTTPステータス、最大再試行回数、再試行の基本待ち時間と最大待ち時間（秒）
+RETRY_STATUSES = (429, 500, 502, 503)
+MAX_RETRIES = 4
+RETRY_BASE_DELAY = 0.5
+MAX_RETRY_DELAY = 10.0
+# webhookのスレッドから呼ばれる読み取りの最大再試行回数（返信トークンの期限が切れないように少なくする）
+WEBHOOK_MAX_RETRIES = 1
+
+# 記録日時の書式
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# 取得済みの行動履歴の有効期間（秒）
+HISTORY_CACHE_TTL = 300
+
+# 書き込み待ちの行をまとめて追記するまでの待ち時間（秒）と、待たずに追記する行数
+FLUSH_INTERVAL = 1.0
+FLUSH_MAX_ROWS = 100
+# 追記に失敗した行を再送するまでの最大待ち時間（秒）
+FLUSH_RETRY_MAX_INTERVAL = 60.0
+
+# Google Sheets APIのスコープ
+SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive'
+]
+
+# 認証済みのサービスオブジェクトとそのAPI呼び出し用ロックのキャッシュ（認証情報の内容ごとにプロセスで1つ）
+_SERVICE_CACHE: Dict[str, Tuple[Any, threading.Lock]] = {}
+_SERVICE_CACHE_LOCK = threading.Lock()
+
+# このプロセスで初期化済みの（スプレッドシートID, 記録シート名, 合計シート名）
+_INITIALIZED_SHEETS = set()
+
+def _sheet_ref(worksheet_name: str) -> str:
+    """数式で参照するためにシート名を引用符で囲む"""
+    return "'" + worksheet_name.replace("'", "''") + "'"
+
 class SheetsHandler:
     """Googleスプレッドシート操作を管理するクラス"""
     
-    def __init__(self, credentials_file: str, spreadsheet_id: str, worksheet_name: str = "ポイント記録"):
+    def __init__(self, credentials_file: str, spreadsheet_id: str, worksheet_name: str = "ポイント記録",
+                 totals_worksheet_name: str = "合計", outbox_path: Optional[str] = None):
         """
         初期化
         
@@ -22,68 +75,170 @@ class SheetsHandler:
             credentials_file: Google API認証情報ファイルのパス
             spreadsheet_id: スプレッドシートのID
             worksheet_name: ワークシート名
+            totals_worksheet_name: ユーザーごとの合計ポイントを集計するワークシート名
+            outbox_path: 書き込み待ちの行を保存するSQLiteファイルのパス（Noneの場合はメモリ上のみで保持）
         """
         self.credentials_file = credentials_file
         self.spreadsheet_id = spreadsheet_id
         self.worksheet_name = worksheet_name
+        self.totals_worksheet_name = totals_worksheet_name
+        # シート名は変わらないため、APIで使う範囲の文字列は事前に作成しておく
+        self._log_range = f"{worksheet_name}!A:E"
+        self._header_range = f"{worksheet_name}!A1:E1"
+        self._user_id_range = f"{worksheet_name}!A:A"
+        self._total_column_range = f"{worksheet_name}!E:E"
+        self._totals_range = f"{totals_worksheet_name}!A:B"
+        self._log_sheet_ref = _sheet_ref(worksheet_name)
         self.service = None
+        # ユーザーごとの合計ポイントと取得時刻のキャッシュ
+        self._totals: Dict[str, int] = {}
+        self._totals_ts: Dict[str, float] = {}
+        # バックグラウンドの記録処理と並行して使われるため、キャッシュを排他制御する
+        # （API呼び出しの再試行中もキャッシュ済みのユーザーを待たせないよう、読み取り中は保持しない）
+        self._totals_lock = threading.RLock()
+        # 合計シートの読み取りと行の追加は1つずつ行う（同じユーザーの行を重複して追加しないように）
+        self._totals_fetch_lock = threading.Lock()
+        # 合計シートでのユーザーごとの行番号（1セル分だけ読み込むために使う）
+        self._totals_rows: Dict[str, int] = {}
+        self._api_lock = threading.Lock()
+        # 書き込み待ちの行と、その完了を通知するFuture（行動の内容とともに保持）
+        self._pending_rows: List[List[Any]] = []
+        self._pending_entries: List[Tuple[Future, str, List[Tuple[str, int]]]] = []
+        self._pending_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # 追記中の行（履歴のキャッシュに反映されるまでの間も履歴に含めるため）
+        self._flushing_rows: List[List[Any]] = []
+        self._flush_timer: Optional[threading.Timer] = None
+        # 連続して追記に失敗した回数（再送までの待ち時間に使う）
+        self._flush_failures = 0
+        # ユーザーごとの行動履歴（取得件数とともに保持）と取得時刻のキャッシュ
+        # 自分で追記した行はその都度反映する
+        self._history: Dict[str, Tuple[List[Dict], int]] = {}
+        self._history_ts: Dict[str, float] = {}
+        self._history_lock = threading.Lock()
+        # 記録シートに従来の形式（user_id列なし）の行があるか（最初の履歴取得時に判定）
+        self._has_legacy_rows: Optional[bool] = None
+        # 書き込み待ちの行を保存するSQLiteの接続とそのロック、書き込み待ちの行のSQLite上のID
+        # （ファイルへの書き込み中にwebhookのスレッドやフラッシュを待たせないよう、_pending_lockとは分ける）
+        self._outbox: Optional[sqlite3.Connection] = None
+        self._outbox_lock = threading.Lock()
+        self._pending_ids: List[int] = []
         self._authenticate()
+        if outbox_path:
+            self._open_outbox(outbox_path)
     
     def _authenticate(self):
-        """Google Sheets APIの認証を行う"""
+        """
+        Google Sheets APIの認証を行う
+        
+        認証情報の内容（バイト列のハッシュ）ごとにサービスオブジェクトをキャッシュするため、
+        JSONのパースと秘密鍵の読み込みはプロセスで1回だけ行われます。
+        """
         try:
-            # スコープの設定
-            SCOPES = [
-                'https://www.googleapis.com/auth/spreadsheets',
-                'https://www.googleapis.com/auth/drive'
-            ]
-            
-            credentials = None
-            
-            # 1. まずファイルから認証情報を読み込みを試行
-            if os.path.exists(self.credentials_file):
-                try:
-                    logger.info(f"認証情報ファイルから読み込み: {self.credentials_file}")
-                    credentials = Credentials.from_service_account_file(
-                        self.credentials_file, scopes=SCOPES
-                    )
-                    logger.info("ファイルからの認証情報読み込みが完了しました")
-                except Exception as e:
-                    logger.warning(f"ファイルからの認証情報読み込みに失敗: {e}")
-            
-            # 2. ファイルが存在しない場合、JSON文字列から直接認証情報を作成
-            if not credentials:
-                google_credentials_json = os.getenv('GOOGLE_CREDENTIALS_JSON')
-                if not google_credentials_json:
-                    raise ValueError("認証情報ファイルが見つからず、GOOGLE_CREDENTIALS_JSONも設定されていません")
+            for source, raw_credentials in self._read_credentials():
+                cache_key = hashlib.blake2b(raw_credentials, digest_size=16).hexdigest()
+                with _SERVICE_CACHE_LOCK:
+                    cached = _SERVICE_CACHE.get(cache_key)
+                    if cached is not None:
+                        logger.info("認証済みのサービスオブジェクトを再利用します")
+                    else:
+                        credentials = self._parse_credentials(source, raw_credentials)
+                        if credentials is None:
+                            continue
+                        cached = (self._build_service(credentials), threading.Lock())
+                        _SERVICE_CACHE[cache_key] = cached
                 
-                try:
-                    logger.info("JSON文字列から認証情報を作成中...")
-                    # JSON文字列をパース
-                    credentials_info = json.loads(google_credentials_json)
-                    
-                    # 認証情報の妥当性を確認
-                    if 'type' not in credentials_info or credentials_info['type'] != 'service_account':
-                        raise ValueError("無効なサービスアカウント認証情報です")
-                    
-                    # 認証情報の作成
-                    credentials = Credentials.from_service_account_info(
-                        credentials_info, scopes=SCOPES
-                    )
-                    logger.info("JSON文字列から認証が完了しました")
-                    
-                except Exception as e:
-                    logger.error(f"JSON文字列の処理に失敗: {e}")
-                    raise
+                # 同じサービスオブジェクトを使うハンドラー間でAPI呼び出しのロックも共有する
+                self.service, self._api_lock = cached
+                return
             
-            # サービスオブジェクトの作成
-            self.service = build('sheets', 'v4', credentials=credentials)
-            logger.info("Google Sheets API認証が完了しました")
+            raise ValueError("認証情報ファイルが見つからず、GOOGLE_CREDENTIALS_JSONも設定されていません")
             
         except Exception as e:
             logger.error(f"Google Sheets API認証エラー: {e}")
             raise
     
+    def _read_credentials(self) -> Iterator[Tuple[str, bytes]]:
+        """
+        認証情報のバイト列を優先順に返す
+        
+        Yields:
+            (読み込み元, 認証情報のバイト列)のタプル（1. 認証情報ファイル 2. GOOGLE_CREDENTIALS_JSON）
+        """
+        # 1. まずファイルから認証情報を読み込みを試行
+        if os.path.exists(self.credentials_file):
+            try:
+                logger.info(f"認証情報ファイルから読み込み: {self.credentials_file}")
+                with open(self.credentials_file, 'rb') as f:
+                    raw_credentials = f.read()
+            except OSError as e:
+                logger.warning(f"ファイルからの認証情報読み込みに失敗: {e}")
+            else:
+                yield 'file', raw_credentials
+        
+        # 2. ファイルが使えない場合、JSON文字列から直接認証情報を作成
+        google_credentials_json = Config.get_env('GOOGLE_CREDENTIALS_JSON')
+        if google_credentials_json:
+            yield 'json', google_credentials_json.encode('utf-8')
+    
+    def _parse_credentials(self, source: str, raw_credentials: bytes) -> Optional['Credentials']:
+        """
+        認証情報のバイト列からサービスアカウント認証情報を作成
+        
+        Args:
+            source: 読み込み元（'file' または 'json'）
+            raw_credentials: 認証情報のバイト列
+            
+        Returns:
+            認証情報（ファイルの内容が不正な場合はNone）
+        """
+        from google.oauth2.service_account import Credentials
+        
+        if source == 'file':
+            try:
+                credentials = Credentials.from_service_account_info(
+                    json.loads(raw_credentials), scopes=SCOPES
+                )
+                logger.info("ファイルからの認証情報読み込みが完了しました")
+                return credentials
+            except Exception as e:
+                logger.warning(f"ファイルからの認証情報読み込みに失敗: {e}")
+                return None
+        
+        try:
+            logger.info("JSON文字列から認証情報を作成中...")
+            # JSON文字列をパース
+            credentials_info = json.loads(raw_credentials)
+            
+            # 認証情報の妥当性を確認
+            if 'type' not in credentials_info or credentials_info['type'] != 'service_account':
+                raise ValueError("無効なサービスアカウント認証情報です")
+            
+            # 認証情報の作成
+            credentials = Credentials.from_service_account_info(
+                credentials_info, scopes=SCOPES
+            )
+            logger.info("JSON文字列から認証が完了しました")
+            return credentials
+            
+        except Exception as e:
+            logger.error(f"JSON文字列の処理に失敗: {e}")
+            raise
+    
+    def _build_service(self, credentials: 'Credentials'):
+        """Google Sheets APIのサービスオブジェクトを作成"""
+        import httplib2
+        from google_auth_httplib2 import AuthorizedHttp
+        from googleapiclient.discovery import build
+        
+        # プロセス内で1つだけ作成してHTTP接続を使い回す（API呼び出しは_executeで排他制御）
+        # 同梱のディスカバリー文書を使うため、ディスカバリーキャッシュは無効化する
+        # 接続を保持するHTTPクライアントを明示的に作成し、タイムアウトを設定する
+        authorized_http = AuthorizedHttp(credentials, http=httplib2.Http(timeout=HTTP_TIMEOUT))
+        service = build('sheets', 'v4', http=authorized_http, cache_discovery=False, static_discovery=True)
+        logger.info("Google Sheets API認証が完了しました")
+        return service
+    
     def get_total_points(self, user_id: str) -> int:
         """
         ユーザーの合計ポイントを取得
@@ -92,39 +247,286 @@ class SheetsHandler:
             user_id: ユーザーID
             
         Returns:
-            合計ポイント
+            合計ポイント（読み取りエラー時は0）
+        """
+        total_points = self._lookup_total(user_id)
+        return 0 if total_points is None else total_points
+    
+    def _lookup_total(self, user_id: str) -> Optional[int]:
+        """
+        ユーザーの合計ポイントをキャッシュ、なければスプレッドシートから取得
+        
+        Args:
+            user_id: ユーザーID
+            
+        Returns:
+            合計ポイント（読み取りエラー時はNone、キャッシュもしない）
+        """
+        # キャッシュが有効ならスプレッドシートを読まずに返す
+        cached = self._cached_total(user_id)
+        if cached is not None:
+            return cached
+        
+        with self._totals_fetch_lock:
+            # 待っている間に他のスレッドが取得していればそれを使う
+            cached = self._cached_total(user_id)
+            if cached is not None:
+                return cached
+            total_points = self._fetch_total_points(user_id)
+        if total_points is None:
+            return None
+        
+        with self._totals_lock:
+            # 読み取り中に反映された予約があればそちらを優先する
+            cached = self._cached_total(user_id)
+            if cached is not None:
+                return cached
+            self._cache_total(user_id, total_points)
+            return total_points
+    
+    def _cached_total(self, user_id: str) -> Optional[int]:
+        """キャッシュが有効な場合はユーザーの合計ポイントを返す（無効な場合はNone）"""
+        with self._totals_lock:
+            cached_at = self._totals_ts.get(user_id)
+            if cached_at is not None and time.monotonic() - cached_at < TOTALS_CACHE_TTL:
+                return self._totals[user_id]
+            return None
+    
+    def get_totals_bulk(self, user_ids: Optional[List[str]] = None) -> Dict[str, int]:
+        """
+        複数ユーザーの合計ポイントを1回の読み取りでまとめて取得し、キャッシュに反映
+        
+        Args:
+            user_ids: ユーザーIDのリスト（Noneの場合は合計シートの全ユーザー）
+            
+        Returns:
+            ユーザーIDと合計ポイントの辞書（読み取りエラー時は空の辞書）
+        """
+        with self._totals_fetch_lock:
+            totals = self._fetch_totals(user_ids)
+        if totals is None:
+            return {}
+        
+        with self._totals_lock:
+            now = time.monotonic()
+            for user_id, total_points in totals.items():
+                # 記録待ちのポイントを反映済みの有効なキャッシュは上書きしない
+                cached_at = self._totals_ts.get(user_id)
+                if cached_at is not None and now - cached_at < TOTALS_CACHE_TTL:
+                    totals[user_id] = self._totals[user_id]
+                else:
+                    self._cache_total(user_id, total_points)
+            return totals
+    
+    def _fetch_total_points(self, user_id: str) -> Optional[int]:
+        """
+        合計シートからユーザーの合計ポイントを取得
+        
+        Args:
+            user_id: ユーザーID
+            
+        Returns:
+            合計ポイント（読み取りエラー時はNone）
+        """
+        # 合計シートの行番号がわかっていれば、そのユーザーの行だけを読み込む
+        row_number = self._totals_rows.get(user_id)
+        if row_number is not None:
+            try:
+                result = self._execute(self.service.spreadsheets().values().get(
+                    spreadsheetId=self.spreadsheet_id,
+                    range=f"{self.totals_worksheet_name}!A{row_number}:B{row_number}",
+                    valueRenderOption='UNFORMATTED_VALUE',
+                    fields='values'
+                ), max_retries=WEBHOOK_MAX_RETRIES)
+            except HttpError as e:
+                logger.error(f"スプレッドシート読み取りエラー: {e}")
+                return None
+            
+            values = result.get('values', [])
+            if values and values[0] and values[0][0] == user_id:
+                return self._parse_total(values[0][1] if len(values[0]) >= 2 else 0)
+            # 行が移動・削除されていた場合は合計シート全体から探し直す
+            del self._totals_rows[user_id]
+        
+        totals = self._fetch_totals([user_id])
+        if totals is None:
+            return None
+        return totals.get(user_id)
+    
+    def _fetch_totals(self, user_ids: Optional[List[str]] = None) -> Optional[Dict[str, int]]:
+        """
+        合計シートからユーザーの合計ポイントを取得
+        
+        合計はスプレッドシート側のSUMIF数式で集計されるため、
+        記録シート全体ではなく合計シート（1ユーザー1行）だけを読み込みます。
+        合計シートに行がないユーザーは、数式の行をまとめて追加してその計算結果を返します。
+        
+        Args:
+            user_ids: ユーザーIDのリスト（Noneの場合は合計シートの全ユーザー）
+            
+        Returns:
+            ユーザーIDと合計ポイントの辞書（読み取りエラー時はNone）
         """
         try:
-            # ユーザーの記録を検索
-            range_name = f"{self.worksheet_name}!A:E"
-            result = self.service.spreadsheets().values().get(
+            range_name = self._totals_range
+            result = self._execute(self.service.spreadsheets().values().get(
                 spreadsheetId=self.spreadsheet_id,
-                range=range_name
-            ).execute()
+                range=range_name,
+                valueRenderOption='UNFORMATTED_VALUE',
+                fields='values'
+            ), max_retries=WEBHOOK_MAX_RETRIES)
             
-            values = result.get('values', [])
-            if not values:
-                return 0
-            
-            # ヘッダー行をスキップ
-            total_points = 0
-            for row in values[1:]:  # ヘッダーを除く
-                if len(row) >= 5 and row[0] == user_id:  # 新しい形式（user_id列あり）
-                    try:
-                        total_points += int(row[3])  # ポイント列
-                    except (ValueError, IndexError):
-                        continue
-                elif len(row) >= 4:  # 従来の形式（user_id列なし）
-                    try:
-                        total_points += int(row[2])  # ポイント列
-                    except (ValueError, IndexError):
-                        continue
+            # ヘッダー行をスキップしてユーザーごとの合計を取得
+            found: Dict[str, int] = {}
+            for row_number, row in enumerate(result.get('values', [])[1:], start=2):
+                if not row:
+                    continue
+                self._totals_rows[row[0]] = row_number
+                total_points = self._parse_total(row[1] if len(row) >= 2 else 0)
+                if total_points is not None:
+                    found[row[0]] = total_points
             
-            return total_points
+            if user_ids is None:
+                return found
+            
+            # 初めてのユーザーは集計用の行をまとめて追加
+            missing = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in found]
+            if missing:
+                result = self._execute(self.service.spreadsheets().values().append(
+                    spreadsheetId=self.spreadsheet_id,
+                    range=range_name,
+                    valueInputOption='USER_ENTERED',
+                    insertDataOption='INSERT_ROWS',
+                    includeValuesInResponse=True,
+                    responseValueRenderOption='UNFORMATTED_VALUE',
+                    fields='updates(updatedRange,updatedData(values))',
+                    body={'values': [[user_id, self._total_formula(user_id)] for user_id in missing]}
+                ), idempotent=False, max_retries=WEBHOOK_MAX_RETRIES)
+                logger.info(f"合計シートにユーザーを追加: {', '.join(missing)}")
+                
+                # 追加した行の行番号を記録（例: '合計'!A5:B6）
+                updated_range = result.get('updates', {}).get('updatedRange', '')
+                first_row = re.search(r'!A(\d+)', updated_range)
+                if first_row:
+                    for offset, user_id in enumerate(missing):
+                        self._totals_rows[user_id] = int(first_row.group(1)) + offset
+                
+                added = result.get('updates', {}).get('updatedData', {}).get('values', [])
+                for index, user_id in enumerate(missing):
+                    if index < len(added) and len(added[index]) >= 2:
+                        total_points = self._parse_total(added[index][1])
+                        if total_points is not None:
+                            found[user_id] = total_points
+                    else:
+                        found[user_id] = 0
+            
+            return {user_id: found[user_id] for user_id in user_ids if user_id in found}
             
         except HttpError as e:
             logger.error(f"スプレッドシート読み取りエラー: {e}")
-            return 0
+            return None
+    
+    def _total_formula(self, user_id: str) -> str:
+        """
+        ユーザーの合計ポイントを集計する数式を作成
+        
+        新しい形式の行はユーザーIDが一致する行のポイント列（D列）を、
+        従来の形式の行（合計ポイント列が空）はすべてのユーザーを対象にC列を合計します。
+        """
+        log_sheet = self._log_sheet_ref
+        quoted_user_id = user_id.replace('"', '""')
+        return (
+            f'=SUMIF({log_sheet}!A:A,"{quoted_user_id}",{log_sheet}!D:D)'
+            f'+SUMIFS({log_sheet}!C:C,{log_sheet}!E:E,"")'
+        )
+    
+    @staticmethod
+    def _parse_total(value) -> Optional[int]:
+        """合計シートのセルの値を整数に変換（数式エラー等の場合はNone）"""
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            logger.error(f"合計ポイントの値が不正です: {value}")
+            return None
+    
+    def _cache_total(self, user_id: str, total_points: int):
+        """ユーザーの合計ポイントをキャッシュに保存"""
+        with self._totals_lock:
+            self._totals[user_id] = total_points
+            self._totals_ts[user_id] = time.monotonic()
+    
+    def reserve_points(self, user_id: str, points: int) -> Optional[int]:
+        """
+        記録前にポイントをキャッシュ上の合計へ反映
+        
+        スプレッドシートへの記録をバックグラウンドで行う場合に、
+        記録完了前に届いた次のメッセージでも正しい合計ポイントを返せるようにします。
+        
+        Args:
+            user_id: ユーザーID
+            points: 加算するポイント
+            
+        Returns:
+            加算前の合計ポイント（合計ポイントを読み取れなかった場合はNone、キャッシュも変更しない）
+        """
+        previous_total = self._lookup_total(user_id)
+        if previous_total is None:
+            return None
+        
+        with self._totals_lock:
+            # 読み取り後に他のメッセージの予約が反映されていれば、それを加算前の合計とする
+            cached = self._cached_total(user_id)
+            if cached is not None:
+                previous_total = cached
+            self._cache_total(user_id, previous_total + points)
+            return previous_total
+    
+    def release_points(self, user_id: str, points: int):
+        """
+        reserve_pointsで反映したポイントをキャッシュ上の合計から差し引く（記録に失敗した場合）
+        
+        同じユーザーの他の書き込み待ちの記録の分は残すため、キャッシュは破棄しません。
+        
+        Args:
+            user_id: ユーザーID
+            points: 差し引くポイント
+        """
+        with self._totals_lock:
+            # キャッシュが切れていれば、次回はスプレッドシートから再取得される
+            if self._cached_total(user_id) is not None:
+                self._totals[user_id] -= points
+    
+    def _execute(self, request, idempotent: bool = True, max_retries: int = MAX_RETRIES):
+        """
+        APIリクエストを実行（一時的なエラーは指数バックオフで再試行）
+        
+        httplib2はスレッドセーフではないため、API呼び出しは1つずつ行います。
+        
+        Args:
+            request: APIリクエスト
+            idempotent: 再実行しても結果が変わらないリクエストの場合True
+                （Falseの場合、処理されていないことが確実な429のみ再試行）
+            max_retries: 最大再試行回数
+            
+        Returns:
+            APIのレスポンス
+        """
+        retry_statuses = RETRY_STATUSES if idempotent else (429,)
+        for attempt in range(max_retries + 1):
+            try:
+                with self._api_lock:
+                    return request.execute()
+            except HttpError as e:
+                if e.resp.status not in retry_statuses or attempt == max_retries:
+                    raise
+                # Retry-Afterヘッダー（秒数）があれば従い（上限あり）、なければジッター付きで待つ
+                retry_after = e.resp.get('retry-after', '')
+                if retry_after.isdigit():
+                    delay = min(float(retry_after), MAX_RETRY_DELAY)
+                else:
+                    delay = RETRY_BASE_DELAY * 2 ** attempt + random.uniform(0, 1)
+                logger.warning(f"APIエラー({e.resp.status})のため{delay:.1f}秒後に再試行します（{attempt + 1}/{max_retries}）")
+                time.sleep(delay)
     
     def record_action(self, user_id: str, action: str, points: int) -> bool:
         """
@@ -138,30 +540,276 @@ class SheetsHandler:
         Returns:
             記録成功時True
         """
+        return self.record_actions_bulk(user_id, [(action, points)])
+    
+    def record_actions_bulk(self, user_id: str, actions: List[Tuple[str, int]], base_total: Optional[int] = None) -> bool:
+        """
+        複数の行動をまとめて記録し、ポイントを追加（1回のAPI呼び出しで追記）
+        
+        Args:
+            user_id: ユーザーID
+            actions: (行動内容, 付与ポイント)のタプルのリスト
+            base_total: 記録前の合計ポイント（reserve_pointsで反映済みの場合に指定）
+            
+        Returns:
+            記録成功時True
+        """
+        if not actions:
+            return True
+        
+        # 現在の合計ポイントを取得（読み取れない場合は誤った合計で記録しない）
+        running_total = self._lookup_total(user_id) if base_total is None else base_total
+        if running_total is None:
+            return False
+        rows = self._build_rows(user_id, actions, running_total)
+        
+        # スプレッドシートに追加
+        if not self._append_rows(rows):
+            return False
+        self._remember_rows(rows)
+        
+        # 書き込み後の合計ポイントをキャッシュに反映（次回の読み取りを省略）
+        # reserve_pointsで反映済みの場合は、その後の予約を上書きしないようにする
+        if base_total is None:
+            self._cache_total(user_id, rows[-1][4])
+        
+        for action, points in actions:
+            logger.info(f"行動記録完了: {user_id} - {action} (+{points}pt)")
+        return True
+    
+    def queue_actions(self, user_id: str, actions: List[Tuple[str, int]], base_total: int) -> Future:
+        """
+        行動の記録を書き込み待ちに追加（一定時間ごと、または一定行数でまとめて追記）
+        
+        Args:
+            user_id: ユーザーID
+            actions: (行動内容, 付与ポイント)のタプルのリスト
+            base_total: 記録前の合計ポイント（reserve_pointsで反映済みの値）
+            
+        Returns:
+            書き込み完了時に成否（bool）が設定されるFuture
+        """
+        future: Future = Future()
+        if not actions:
+            future.set_result(True)
+            return future
+        
+        rows = self._build_rows(user_id, actions, base_total)
+        row_ids = self._save_to_outbox(rows)
+        flush_now = False
+        with self._pending_lock:
+            self._pending_rows.extend(rows)
+            self._pending_ids.extend(row_ids)
+            self._pending_entries.append((future, user_id, actions))
+            # 再送待ちの間は、行数が多くてもタイマーを待つ
+            if len(self._pending_rows) >= FLUSH_MAX_ROWS and not self._flush_failures:
+                flush_now = True
+            elif self._flush_timer is None:
+                self._start_flush_timer()
+        
+        if flush_now:
+            threading.Thread(target=self.flush, daemon=True).start()
+        return future
+    
+    def flush(self) -> bool:
+        """
+        書き込み待ちの行を1回のAPI呼び出しでまとめて追記
+        
+        SQLiteファイルに保存している場合、追記に失敗した行は破棄せずに書き込み待ちへ戻し、
+        間隔を空けて再送します（Futureは追記できるまで完了しません）。
+        
+        Returns:
+            書き込み成功時True（書き込み待ちがない場合もTrue）
+        """
+        # 書き込みの順序を保つため、フラッシュは1つずつ行う
+        with self._flush_lock:
+            with self._pending_lock:
+                rows, entries, row_ids = self._pending_rows, self._pending_entries, self._pending_ids
+                self._pending_rows, self._pending_entries, self._pending_ids = [], [], []
+                self._flushing_rows = rows
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+            
+            if not rows:
+                return True
+            
+            try:
+                success = self._append_rows(rows)
+            except Exception as e:
+                logger.error(f"スプレッドシート書き込みエラー: {e}")
+                success = False
+            
+            if success:
+                # 履歴のキャッシュにも追記した順に反映する
+                self._remember_rows(rows)
+                self._delete_from_outbox(row_ids)
+                self._flush_failures = 0
+            
+            retry_delay = None
+            with self._pending_lock:
+                self._flushing_rows = []
+                if not success and self._outbox is not None:
+                    # 書き込み待ちの先頭に戻し、失敗が続くほど間隔を空けて再送する
+                    self._pending_rows[:0] = rows
+                    self._pending_entries[:0] = entries
+                    self._pending_ids[:0] = row_ids
+                    self._flush_failures += 1
+                    retry_delay = min(FLUSH_INTERVAL * 2 ** self._flush_failures, FLUSH_RETRY_MAX_INTERVAL)
+                    if self._flush_timer is not None:
+                        self._flush_timer.cancel()
+                    self._start_flush_timer(retry_delay)
+            
+            if retry_delay is not None:
+                logger.warning(f"追記に失敗した行を{retry_delay:.0f}秒後に再送します: {len(rows)}行")
+                return False
+        
+        if success:
+            logger.info(f"書き込み待ちの行をまとめて追記: {len(rows)}行")
+        else:
+            # SQLiteファイルを使わない場合は保持できないため、破棄してFutureで失敗を通知する
+            logger.error(f"追記できなかった行を破棄しました: {len(rows)}行")
+        for future, user_id, actions in entries:
+            if success:
+                for action, points in actions:
+                    logger.info(f"行動記録完了: {user_id} - {action} (+{points}pt)")
+            future.set_result(success)
+        return success
+    
+    def _start_flush_timer(self, delay: float = FLUSH_INTERVAL):
+        """一定時間後にflushするタイマーを開始（_pending_lockを取得した状態で呼ぶ）"""
+        self._flush_timer = threading.Timer(delay, self.flush)
+        self._flush_timer.daemon = True
+        self._flush_timer.start()
+    
+    def _open_outbox(self, outbox_path: str):
+        """
+        書き込み待ちの行を保存するSQLiteファイルを開き、前回追記できなかった行を書き込み待ちに戻す
+        
+        Args:
+            outbox_path: SQLiteファイルのパス
+        """
         try:
-            # 現在の合計ポイントを取得
-            current_total = self.get_total_points(user_id)
-            new_total = current_total + points
+            conn = sqlite3.connect(outbox_path, check_same_thread=False, isolation_level=None)
+            # 追記のたびにfsyncを待たないよう、WALモードで書き込む
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS pending_rows ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT, ts TEXT, '
+                'action TEXT, points INTEGER, total INTEGER)'
+            )
+            saved = conn.execute(
+                'SELECT id, user_id, ts, action, points, total FROM pending_rows ORDER BY id'
+            ).fetchall()
+        except sqlite3.Error as e:
+            logger.error(f"書き込み待ちファイルを開けませんでした（メモリ上のみで保持します）: {e}")
+            return
+        
+        self._outbox = conn
+        with self._pending_lock:
+            if saved:
+                # 通知先のFutureはないため、行だけを書き込み待ちに戻す
+                self._pending_rows.extend([list(row[1:]) for row in saved])
+                self._pending_ids.extend([row[0] for row in saved])
+                if self._flush_timer is None:
+                    self._start_flush_timer()
+        if saved:
+            logger.info(f"前回追記できなかった行を書き込み待ちに戻しました: {len(saved)}行")
+    
+    def _save_to_outbox(self, rows: List[List[Any]]) -> List[int]:
+        """
+        書き込み待ちの行をSQLiteファイルに保存
+        
+        Args:
+            rows: 保存する行のリスト
             
-            # 記録データの準備（新しい形式：user_id, 日時, 行動, ポイント, 合計ポイント）
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            row_data = [user_id, timestamp, action, points, new_total]
+        Returns:
+            保存した行のIDのリスト（SQLiteファイルを使わない場合や保存に失敗した場合は空のリスト）
+        """
+        if self._outbox is None:
+            return []
+        row_ids = []
+        with self._outbox_lock:
+            try:
+                self._outbox.execute('BEGIN')
+                for row in rows:
+                    cursor = self._outbox.execute(
+                        'INSERT INTO pending_rows (user_id, ts, action, points, total) VALUES (?, ?, ?, ?, ?)',
+                        row
+                    )
+                    row_ids.append(cursor.lastrowid)
+                self._outbox.execute('COMMIT')
+            except sqlite3.Error as e:
+                logger.error(f"書き込み待ちの行を保存できませんでした: {e}")
+                if self._outbox.in_transaction:
+                    self._outbox.execute('ROLLBACK')
+                return []
+        return row_ids
+    
+    def _delete_from_outbox(self, row_ids: List[int]):
+        """
+        追記を終えた行をSQLiteファイルから削除
+        
+        Args:
+            row_ids: 削除する行のIDのリスト
+        """
+        if self._outbox is None or not row_ids:
+            return
+        with self._outbox_lock:
+            try:
+                self._outbox.execute('BEGIN')
+                self._outbox.executemany('DELETE FROM pending_rows WHERE id = ?', [(row_id,) for row_id in row_ids])
+                self._outbox.execute('COMMIT')
+            except sqlite3.Error as e:
+                logger.error(f"追記済みの行を削除できませんでした: {e}")
+                if self._outbox.in_transaction:
+                    self._outbox.execute('ROLLBACK')
+    
+    def _build_rows(self, user_id: str, actions: List[Tuple[str, int]], running_total: int) -> List[List[Any]]:
+        """
+        記録データを作成（新しい形式：user_id, 日時, 行動, ポイント, 合計ポイント）
+        
+        Args:
+            user_id: ユーザーID
+            actions: (行動内容, 付与ポイント)のタプルのリスト
+            running_total: 記録前の合計ポイント
+            
+        Returns:
+            スプレッドシートに追記する行のリスト
+        """
+        timestamp = time.strftime(TIMESTAMP_FORMAT)
+        rows = []
+        for action, points in actions:
+            running_total += points
+            rows.append([user_id, timestamp, action, points, running_total])
+        return rows
+    
+    def _append_rows(self, rows: List[List[Any]]) -> bool:
+        """
+        記録シートに行を追記（1回のAPI呼び出し）
+        
+        Args:
+            rows: 追記する行のリスト
             
-            # スプレッドシートに追加
-            range_name = f"{self.worksheet_name}!A:E"
+        Returns:
+            書き込み成功時True
+        """
+        try:
+            range_name = self._log_range
             body = {
-                'values': [row_data]
+                'values': rows
             }
             
-            result = self.service.spreadsheets().values().append(
+            self._execute(self.service.spreadsheets().values().append(
                 spreadsheetId=self.spreadsheet_id,
                 range=range_name,
                 valueInputOption='RAW',
                 insertDataOption='INSERT_ROWS',
+                includeValuesInResponse=False,
+                fields='spreadsheetId',
                 body=body
-            ).execute()
-            
-            logger.info(f"行動記録完了: {user_id} - {action} (+{points}pt)")
+            ), idempotent=False)
             return True
             
         except HttpError as e:
@@ -179,21 +827,123 @@ class SheetsHandler:
         Returns:
             行動履歴のリスト
         """
+        # 書き込み待ち・追記中の記録も履歴に含める（追記は待たない）
+        with self._pending_lock:
+            unsent = [row for row in self._flushing_rows + self._pending_rows if row[0] == user_id]
+        
+        # 取得済みの履歴が有効なら、スプレッドシートを読まずに返す
+        with self._history_lock:
+            cached = self._history.get(user_id)
+            if (cached is not None and cached[1] >= limit
+                    and time.monotonic() - self._history_ts[user_id] < HISTORY_CACHE_TTL):
+                return self._merge_unsent(cached[0], unsent, limit)
+        
+        history = self._fetch_user_history(user_id, limit)
+        if history is None:
+            return self._merge_unsent([], unsent, limit)
+        
+        with self._history_lock:
+            self._history[user_id] = (history, limit)
+            self._history_ts[user_id] = time.monotonic()
+        return self._merge_unsent(history, unsent, limit)
+    
+    @staticmethod
+    def _merge_unsent(history: List[Dict], rows: List[List[Any]], limit: int) -> List[Dict]:
+        """
+        履歴にまだ反映されていない行を加え、最新の指定件数を返す
+        
+        Args:
+            history: 取得済みの行動履歴
+            rows: 書き込み待ち・追記中の行のリスト（新しい形式、古い順）
+            limit: 取得件数
+            
+        Returns:
+            行動履歴のリスト
+        """
+        merged = list(history)
+        # 追記直後の行は取得済みの履歴にも含まれている場合があるため、重複を除く
+        known = {(record['timestamp'], record['action'], record['points'], record['total']) for record in history}
+        for _, timestamp, action, points, total in rows:
+            if (timestamp, action, points, total) not in known:
+                merged.append({
+                    'timestamp': timestamp,
+                    'action': action,
+                    'points': points,
+                    'total': total
+                })
+        return merged[-limit:]
+    
+    def _fetch_user_history(self, user_id: str, limit: int) -> Optional[List[Dict]]:
+        """
+        スプレッドシートからユーザーの行動履歴を取得
+        
+        Args:
+            user_id: ユーザーID
+            limit: 取得件数
+            
+        Returns:
+            行動履歴のリスト（読み取りエラー時はNone）
+        """
         try:
-            range_name = f"{self.worksheet_name}!A:E"
-            result = self.service.spreadsheets().values().get(
+            # ユーザーID列（従来の形式の行がありうる場合は合計ポイント列も）だけを取得して、対象の行番号を特定
+            ranges = [self._user_id_range]
+            if self._has_legacy_rows is not False:
+                ranges.append(self._total_column_range)
+            result = self._execute(self.service.spreadsheets().values().batchGet(
                 spreadsheetId=self.spreadsheet_id,
-                range=range_name
-            ).execute()
+                ranges=ranges,
+                majorDimension='COLUMNS',
+                valueRenderOption='UNFORMATTED_VALUE',
+                fields='valueRanges(values)'
+            ), max_retries=WEBHOOK_MAX_RETRIES)
             
-            values = result.get('values', [])
-            if not values:
+            columns = [
+                (value_range.get('values') or [[]])[0]
+                for value_range in result.get('valueRanges', [])
+            ]
+            if len(columns) < len(ranges) or not columns[0]:
+                return []
+            user_ids = columns[0]
+            
+            # ヘッダー行をスキップして、ユーザーの記録の行番号（1始まり）を抽出
+            if len(columns) == 1:
+                # 従来の形式の行がないことを確認済みなら、ユーザーIDの比較だけで済む
+                row_numbers = [index + 1 for index in range(1, len(user_ids)) if user_ids[index] == user_id]
+            else:
+                totals = columns[1]
+                row_numbers = []
+                has_legacy_rows = False
+                for index in range(1, len(user_ids)):
+                    if index < len(totals) and totals[index] != '':
+                        if user_ids[index] == user_id:  # 新しい形式
+                            row_numbers.append(index + 1)
+                    elif user_ids[index] != '':  # 従来の形式（user_id列なし、合計ポイント列が空）
+                        # 従来の形式の場合は、すべての記録を対象とする
+                        row_numbers.append(index + 1)
+                        has_legacy_rows = True
+                # 新しく追記する行は常に新しい形式なので、判定結果は以降も使い回せる
+                self._has_legacy_rows = has_legacy_rows
+            
+            # 最新の記録から指定件数の行だけを取得
+            row_numbers = row_numbers[-limit:]
+            if not row_numbers:
                 return []
             
-            # ヘッダー行をスキップして、ユーザーの記録のみを抽出
+            result = self._execute(self.service.spreadsheets().values().batchGet(
+                spreadsheetId=self.spreadsheet_id,
+                ranges=[f"{self.worksheet_name}!A{row_number}:E{row_number}" for row_number in row_numbers],
+                valueRenderOption='UNFORMATTED_VALUE',
+                dateTimeRenderOption='FORMATTED_STRING',
+                fields='valueRanges(values)'
+            ), max_retries=WEBHOOK_MAX_RETRIES)
+            
             history = []
-            for row in values[1:]:
-                if len(row) >= 5 and row[0] == user_id:  # 新しい形式
+            for value_range in result.get('valueRanges', []):
+                values = value_range.get('values')
+                if not values:
+                    continue
+                row = values[0]
+                if len(row) >= 5:  # 新しい形式
                     history.append({
                         'timestamp': row[1],
                         'action': row[2],
@@ -201,7 +951,6 @@ class SheetsHandler:
                         'total': int(row[4])
                     })
                 elif len(row) >= 4:  # 従来の形式（user_id列なし）
-                    # 従来の形式の場合は、すべての記録を対象とする
                     history.append({
                         'timestamp': row[0],
                         'action': row[1],
@@ -209,12 +958,32 @@ class SheetsHandler:
                         'total': int(row[3])
                     })
             
-            # 最新の記録から指定件数まで返す
-            return history[-limit:]
+            return history
             
         except HttpError as e:
             logger.error(f"履歴取得エラー: {e}")
-            return []
+            return None
+    
+    def _remember_rows(self, rows: List[List[Any]]):
+        """
+        追記した行を取得済みの履歴に反映（次回の履歴取得でスプレッドシートを読まずに済むように）
+        
+        Args:
+            rows: 追記した行のリスト（新しい形式）
+        """
+        with self._history_lock:
+            for user_id, timestamp, action, points, total in rows:
+                cached = self._history.get(user_id)
+                if cached is None:
+                    continue
+                history, cached_limit = cached
+                history.append({
+                    'timestamp': timestamp,
+                    'action': action,
+                    'points': points,
+                    'total': total
+                })
+                del history[:-cached_limit]
     
     def initialize_sheet(self) -> bool:
         """
@@ -223,16 +992,22 @@ class SheetsHandler:
         Returns:
             初期化成功時True
         """
+        # このプロセスで初期化済みのシートは確認を省略
+        sheet_key = (self.spreadsheet_id, self.worksheet_name, self.totals_worksheet_name)
+        if sheet_key in _INITIALIZED_SHEETS:
+            return True
+        
         try:
             # ヘッダー行の設定（新しい形式）
             headers = ['ユーザーID', '日時', '行動', 'ポイント', '合計ポイント']
             
-            # 既存のデータを確認
-            range_name = f"{self.worksheet_name}!A:E"
-            result = self.service.spreadsheets().values().get(
+            # 既存のヘッダー行だけを確認
+            range_name = self._header_range
+            result = self._execute(self.service.spreadsheets().values().get(
                 spreadsheetId=self.spreadsheet_id,
-                range=range_name
-            ).execute()
+                range=range_name,
+                fields='values'
+            ))
             
             values = result.get('values', [])
             
@@ -242,12 +1017,12 @@ class SheetsHandler:
                     'values': [headers]
                 }
                 
-                self.service.spreadsheets().values().update(
+                self._execute(self.service.spreadsheets().values().update(
                     spreadsheetId=self.spreadsheet_id,
                     range=range_name,
                     valueInputOption='RAW',
                     body=body
-                ).execute()
+                ))
                 
                 logger.info("スプレッドシートを初期化しました（新しい形式）")
             else:
@@ -259,17 +1034,43 @@ class SheetsHandler:
                         'values': [headers]
                     }
                     
-                    self.service.spreadsheets().values().update(
+                    self._execute(self.service.spreadsheets().values().update(
                         spreadsheetId=self.spreadsheet_id,
-                        range=f"{self.worksheet_name}!A1",
+                        range=self._header_range,
                         valueInputOption='RAW',
                         body=body
-                    ).execute()
+                    ))
                     
                     logger.info("スプレッドシートのヘッダーを更新しました")
             
+            # 合計ポイント集計用のシートを用意
+            self._ensure_totals_sheet()
+            
+            _INITIALIZED_SHEETS.add(sheet_key)
             return True
             
         except HttpError as e:
             logger.error(f"スプレッドシート初期化エラー: {e}")
-            return False 
\ No newline at end of file
+            return False
+    
+    def _ensure_totals_sheet(self):
+        """合計ポイント集計用のワークシートがなければ作成"""
+        result = self._execute(self.service.spreadsheets().get(
+            spreadsheetId=self.spreadsheet_id,
+            fields='sheets.properties.title'
+        ))
+        titles = {sheet['properties']['title'] for sheet in result.get('sheets', [])}
+        if self.totals_worksheet_name in titles:
+            return
+        
+        self._execute(self.service.spreadsheets().batchUpdate(
+            spreadsheetId=self.spreadsheet_id,
+            body={'requests': [{'addSheet': {'properties': {'title': self.totals_worksheet_name}}}]}
+        ), idempotent=False)
+        self._execute(self.service.spreadsheets().values().update(
+            spreadsheetId=self.spreadsheet_id,
+            range=f"{self.totals_worksheet_name}!A1",
+            valueInputOption='RAW',
+            body={'values': [['ユーザーID', '合計ポイント']]}
+        ))
+        logger.info(f"合計ポイント集計用のワークシートを作成しました: {self.totals_worksheet_name}")